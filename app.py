@@ -2,12 +2,28 @@
 
 import os
 import json
+import orjson
 import base64
 import io
+import re
+import tempfile
+import hashlib
+import threading
+import multiprocessing
+import asyncio
+import sqlite3
+import time
+import uuid
+import fcntl
+from datetime import datetime
+import httpx
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, render_template, redirect, url_for, flash, session, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
-from PIL import Image
-from openai import OpenAI
+from PIL import Image, ImageOps, ImageStat
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pdf2image import convert_from_path
 from dotenv import load_dotenv
 
@@ -23,89 +39,304 @@ POPPLER_PATH = os.getenv('POPPLER_PATH')
 # --- ROBUSTNÍ NASTAVENÍ CEST PRO UKLÁDÁNÍ SOUBORŮ ---
 basedir = os.path.abspath(os.path.dirname(__file__))
 STATIC_DIR = os.path.join(basedir, 'static')
-UPLOAD_FOLDER = os.path.join(STATIC_DIR, 'uploads')
-PROCESSED_FOLDER = os.path.join(STATIC_DIR, 'processed')
-PREVIEW_FOLDER = os.path.join(STATIC_DIR, 'previews')
-DB_FOLDER = os.path.join(STATIC_DIR, 'db')
+# Starší verze ukládaly faktury do static/; _migrate_legacy_files je přesune do DATA_DIR
+LEGACY_PROCESSED_FOLDER = os.path.join(STATIC_DIR, 'processed')
+LEGACY_PREVIEW_FOLDER = os.path.join(STATIC_DIR, 'previews')
+LEGACY_DB_FOLDER = os.path.join(STATIC_DIR, 'db')
+# Neveřejná data mimo static/
+DATA_DIR = os.path.join(basedir, 'data')
+UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
+PROCESSED_FOLDER = os.path.join(DATA_DIR, 'processed')
+PREVIEW_FOLDER = os.path.join(DATA_DIR, 'previews')
+DB_PATH = os.path.join(DATA_DIR, 'faktury.db')
+CACHE_FOLDER = os.path.join(DATA_DIR, '_cache')
 
 app.config.update({
     'UPLOAD_FOLDER': UPLOAD_FOLDER,
     'PROCESSED_FOLDER': PROCESSED_FOLDER,
-    'PREVIEW_FOLDER': PREVIEW_FOLDER,
-    'DB_FOLDER': DB_FOLDER
+    'PREVIEW_FOLDER': PREVIEW_FOLDER
 })
 
-for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, PREVIEW_FOLDER, DB_FOLDER]:
+for folder in [DATA_DIR, UPLOAD_FOLDER, PROCESSED_FOLDER, PREVIEW_FOLDER, CACHE_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+UPLOAD_MAX_CONCURRENCY = 8
+OPENAI_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, max_connections=32)
+OPENAI_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+DASHBOARD_PAGE_SIZE = 50
+PDF_THREADS = max(1, (os.cpu_count() or 2) - 1)
+PDF_DPI = 200
+# Zmenšení jen zkracuje upload, počet tokenů neovlivní
+AI_IMAGE_MAX_SIZE = (1600, 1600)
+PREVIEW_SIZE = (400, 600)
+# Průměrná sytost, pod kterou se náhled ukládá ve stupních šedi
+GRAYSCALE_MAX_SATURATION = 12
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+# Poppler a PIL běží v samostatných procesech (každý importuje celý app.py, proto max 4)
+RASTER_WORKERS = min(4, os.cpu_count() or 1)
+RASTER_POOL = ProcessPoolExecutor(max_workers=RASTER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+_raster_pool_lock = threading.Lock()
+
+_INVALID_TABLE = str.maketrans('', '', '/\\:*?"<>|')
+# "RRMMDD (dodavatel), (popis)"
+_FILENAME_RE = re.compile(r'^(.*?) \((.+?)\), \((.+)\)$')
+_INVOICE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_ISO_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+PROMPT_STATIC = """
+Jsi vysoce přesný asistent pro české účetnictví. Tvým úkolem je analyzovat obrázek faktury a extrahovat klíčové informace pro automatické přejmenování souboru. Buď maximálně pečlivý.
+Z přiloženého obrázku faktury extrahuj následující informace a vrať je striktně ve formátu JSON:
+1. "supplier_name": Přesný a úplný název dodavatelské firmy. Pokud nenajdeš, vrať "Neznámý dodavatel".
+2. "issue_date": Datum vystavení faktury (nebo DUZP). Formát musí být striktně `RRRR-MM-DD`. Pokud nenajdeš, vrať "RRRR-MM-DD".
+3. "description": Velmi stručný souhrn fakturovaných položek (max 5 slov). Pokud popis nelze určit, vrať "Neznámé zboží".
+4. "detailed_description": Podrobnější popis fakturovaných položek (všechny položky, počty, ceny).
+Vrať pouze a jen validní JSON objekt.
+"""
 
 # --- POMOCNÉ FUNKCE ---
 
-def get_image_base64(file_path):
+def rasterize_first_page(pdf_path):
+    with tempfile.TemporaryDirectory() as output_folder:
+        pages = convert_from_path(pdf_path, PDF_DPI, first_page=1, last_page=1, poppler_path=POPPLER_PATH or None,
+                                  thread_count=PDF_THREADS, fmt='jpeg', output_folder=output_folder, paths_only=True)
+        if not pages: return None
+        with Image.open(pages[0]) as page:
+            return page.copy()
+
+def get_image_base64(source):
+    # source je cesta k PDF, nebo obsah obrázku jako bytes
     try:
-        if file_path.lower().endswith('.pdf'):
-            pages = convert_from_path(file_path, 300, first_page=1, last_page=1, poppler_path=POPPLER_PATH or None)
-            if not pages: return None
-            buf = io.BytesIO()
-            pages[0].save(buf, format='JPEG')
-            return base64.b64encode(buf.getvalue()).decode('utf-8')
+        if isinstance(source, bytes):
+            img = ImageOps.exif_transpose(Image.open(io.BytesIO(source)))
         else:
-            with open(file_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            img = rasterize_first_page(source)
+            if not img: return None, None, None
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            # Průhlednost na bílé pozadí
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+        img.thumbnail(AI_IMAGE_MAX_SIZE, Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=85, optimize=False)
+        image_bytes = buf.getbuffer()
+        image_url = DATA_URL_PREFIX + base64.b64encode(image_bytes).decode('ascii')
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        img.thumbnail(PREVIEW_SIZE, Image.LANCZOS)
+        return image_url, image_hash, img
     except Exception as e:
         print(f"FATAL ERROR v get_image_base64: {e}")
         if "Poppler" in str(e): raise Exception("PopplerNotFound")
-        return None
+        return None, None, None
 
-def extract_invoice_data_from_image(base64_image):
-    prompt = """
-    Jsi vysoce přesný asistent pro české účetnictví. Tvým úkolem je analyzovat obrázek faktury a extrahovat klíčové informace pro automatické přejmenování souboru. Buď maximálně pečlivý.
-    Z přiloženého obrázku faktury extrahuj následující informace a vrať je striktně ve formátu JSON:
-    1. "supplier_name": Přesný a úplný název dodavatelské firmy. Pokud nenajdeš, vrať "Neznámý dodavatel".
-    2. "issue_date": Datum vystavení faktury (nebo DUZP). Formát musí být striktně `RRRR-MM-DD`. Pokud nenajdeš, vrať "RRRR-MM-DD".
-    3. "description": Velmi stručný souhrn fakturovaných položek (max 5 slov). Pokud popis nelze určit, vrať "Neznámé zboží".
-    4. "detailed_description": Podrobnější popis fakturovaných položek (všechny položky, počty, ceny).
-    Vrať pouze a jen validní JSON objekt.
-    """
+async def run_in_raster_pool(fn, *args):
+    global RASTER_POOL
+    pool = RASTER_POOL
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]}],
-            response_format={"type": "json_object"},
-            max_tokens=500,
-        )
-        return json.loads(response.choices[0].message.content)
-    except Exception as e:
-        print(f"Chyba při volání OpenAI Vision API: {e}")
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        with _raster_pool_lock:
+            if RASTER_POOL is pool:
+                RASTER_POOL = ProcessPoolExecutor(max_workers=RASTER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+                pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+def needs_high_detail(data):
+    if data.get('supplier_name', 'Neznámý dodavatel') == 'Neznámý dodavatel':
+        return True
+    try:
+        datetime.strptime(data.get('issue_date') or '', '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return True # chybí, "RRRR-MM-DD" nebo neplatné datum
+    return False
+
+async def extract_invoice_data_from_image(aclient, image_url):
+    data, used_detail = None, None
+    # "high" jen když v "low" chybí dodavatel nebo datum
+    for detail in ('low', 'high'):
+        try:
+            response = await aclient.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": PROMPT_STATIC},
+                    {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url, "detail": detail}}]},
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=500,
+                temperature=0,
+                seed=42,
+            )
+            data, used_detail = json.loads(response.choices[0].message.content), detail
+        except Exception as e:
+            print(f"Chyba při volání OpenAI Vision API: {e}")
+            return data, used_detail
+        if not needs_high_detail(data):
+            break
+    return data, used_detail
+
+def _silent_unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _write_json_atomic(path, data):
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        try:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        except BaseException:
+            f.close()
+            _silent_unlink(f.name)
+            raise
+    try:
+        os.replace(f.name, path)
+    except BaseException:
+        _silent_unlink(f.name)
+        raise
+
+@lru_cache(maxsize=256)
+def _read_cached_extraction(image_hash):
+    with open(os.path.join(CACHE_FOLDER, f"{image_hash}.json"), 'rb') as f:
+        return orjson.loads(f.read())
+
+def get_cached_extraction(image_hash):
+    try:
+        return dict(_read_cached_extraction(image_hash))
+    except (OSError, ValueError):
         return None
 
-def create_preview(original_path, preview_filename):
+def save_cached_extraction(image_hash, data):
+    _write_json_atomic(os.path.join(CACHE_FOLDER, f"{image_hash}.json"), data)
+
+def create_preview(img, preview_filename):
     preview_path = os.path.join(app.config['PREVIEW_FOLDER'], preview_filename)
     try:
-        if original_path.lower().endswith('.pdf'):
-            pages = convert_from_path(original_path, 200, first_page=1, last_page=1, poppler_path=POPPLER_PATH or None)
-            if pages: pages[0].save(preview_path, 'JPEG')
-        else:
-            img = Image.open(original_path)
-            img.thumbnail((400, 600))
-            img.save(preview_path, 'JPEG')
+        img.thumbnail(PREVIEW_SIZE, Image.LANCZOS)
+        if img.mode == 'RGB' and ImageStat.Stat(img.convert('HSV').getchannel('S')).mean[0] < GRAYSCALE_MAX_SATURATION:
+            img = img.convert('L')
+        img.save(preview_path, 'JPEG')
+        img.save(f"{os.path.splitext(preview_path)[0]}.webp", 'WEBP', quality=78, method=4)
         return True
     except Exception as e:
         print(f"Nepodařilo se vytvořit náhled: {e}")
         return False
 
-def save_invoice_details(filename, details):
-    db_path = os.path.join(app.config['DB_FOLDER'], f"{filename}.json")
-    with open(db_path, 'w', encoding='utf-8') as f:
-        json.dump(details, f, ensure_ascii=False, indent=4)
-
-def load_invoice_details(filename):
-    db_path = os.path.join(app.config['DB_FOLDER'], f"{filename}.json")
-    if os.path.exists(db_path):
-        with open(db_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return None
+def build_invoice_filename(issue_date, supplier, description, extension):
+    date_str = issue_date.replace('-', '')[2:]
+    # *** PŘESNÝ FORMÁT NÁZVU SOUBORU ***
+    base_new_filename = f"{date_str} ({supplier}), ({description}), E F ZAP".translate(_INVALID_TABLE)
+    return f"{base_new_filename.strip()}{extension}"
+
+# Jedno sdílené spojení, otevírá se až při prvním dotazu
+_db = None
+_db_lock = threading.Lock()
+
+def _get_db():
+    global _db
+    if _db is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS invoices(id TEXT PRIMARY KEY, filename TEXT, date TEXT, supplier TEXT, description TEXT, detailed TEXT, mtime REAL, original_ext TEXT, has_webp INTEGER NOT NULL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_mtime ON invoices(mtime)')
+        try:
+            _migrate_legacy_files(conn)
+        except Exception:
+            conn.close()
+            raise
+        _db = conn
+    return _db
+
+def db_query(sql, params=()):
+    with _db_lock:
+        return _get_db().execute(sql, params).fetchall()
+
+def db_write(sql, params=()):
+    with _db_lock:
+        conn = _get_db()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+def _migrate_legacy_files(conn):
+    # Převod starých faktur pojmenovaných podle obsahu; workery se střídají pod zámkem
+    with open(os.path.join(DATA_DIR, 'migrate.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with os.scandir(LEGACY_PROCESSED_FOLDER) as it:
+                legacy = [e for e in it if e.is_file() and not _INVOICE_ID_RE.match(os.path.splitext(e.name)[0])]
+        except FileNotFoundError:
+            return
+        for entry in legacy:
+            try:
+                _migrate_legacy_file(conn, entry)
+            except OSError as e:
+                print(f"Nepodařilo se převést fakturu '{entry.name}': {e}")
+
+def _migrate_legacy_file(conn, entry):
+    base_name, extension = os.path.splitext(entry.name)
+    try:
+        mtime = entry.stat().st_mtime
+    except FileNotFoundError:
+        return # mezitím převedl jiný worker
+    # Řádek se zapisuje před přejmenováním; po pádu mezi nimi se použije znovu
+    invoice_id = None
+    for row in conn.execute('SELECT id FROM invoices WHERE filename = ? AND original_ext = ?', (entry.name, extension)).fetchall():
+        if not os.path.exists(os.path.join(PROCESSED_FOLDER, f"{row['id']}{extension}")):
+            invoice_id = row['id']
+            break
+    sidecar_path = os.path.join(LEGACY_DB_FOLDER, f"{base_name}.json")
+    sidecar_loaded = False
+    try:
+        with open(sidecar_path, 'rb') as f:
+            details = orjson.loads(f.read())
+        sidecar_loaded = True
+    except FileNotFoundError:
+        details = {}
+    except (OSError, ValueError) as e:
+        print(f"Nepodařilo se načíst sidecar '{sidecar_path}': {e}")
+        details = {}
+    inserted = invoice_id is None
+    if inserted:
+        invoice_id = uuid.uuid4().hex
+        parsed = parse_filename(entry.name)
+        with conn:
+            conn.execute('INSERT INTO invoices(id, filename, date, supplier, description, detailed, mtime, original_ext, has_webp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (invoice_id, entry.name, parsed['date'], parsed['supplier'], parsed['description'],
+                          _detailed_text(details), mtime, extension, False))
+    try:
+        os.replace(entry.path, os.path.join(PROCESSED_FOLDER, f"{invoice_id}{extension}"))
+    except FileNotFoundError:
+        if inserted and not os.path.exists(os.path.join(PROCESSED_FOLDER, f"{invoice_id}{extension}")):
+            with conn:
+                conn.execute('DELETE FROM invoices WHERE id = ?', (invoice_id,))
+        return
+    for preview_ext in ('.jpg', '.webp'):
+        try:
+            os.replace(os.path.join(LEGACY_PREVIEW_FOLDER, f"{base_name}{preview_ext}"), os.path.join(PREVIEW_FOLDER, f"{invoice_id}{preview_ext}"))
+        except FileNotFoundError:
+            pass
+    if os.path.exists(os.path.join(PREVIEW_FOLDER, f"{invoice_id}.webp")):
+        with conn:
+            conn.execute('UPDATE invoices SET has_webp = 1 WHERE id = ?', (invoice_id,))
+    if sidecar_loaded:
+        _silent_unlink(sidecar_path)
+    elif os.path.exists(sidecar_path):
+        # Nečitelný sidecar nemazat, jen odložit pro ruční kontrolu
+        os.replace(sidecar_path, os.path.join(DATA_DIR, f"{base_name}.json.bad"))
+
+def _detailed_text(data):
+    detailed = data.get('detailed_description')
+    if detailed is None or isinstance(detailed, str): return detailed
+    return orjson.dumps(detailed).decode('utf-8')
+
+def load_invoice_details(invoice_id):
+    rows = db_query('SELECT detailed FROM invoices WHERE id = ?', (invoice_id,))
+    if not rows: return None
+    return {'detailed_description': rows[0]['detailed']}
 
 def parse_filename(filename):
     base_name = os.path.splitext(filename)[0]
@@ -113,13 +344,7 @@ def parse_filename(filename):
         base_name = base_name[:-len(', E F ZAP')]
     
     try:
-        parts = base_name.split(' (', 1)
-        date_str = parts[0]
-        
-        remaining = parts[1]
-        supplier, description = remaining.split('), (', 1)
-        description = description[:-1] # Remove trailing ')'
-        
+        date_str, supplier, description = _FILENAME_RE.match(base_name).groups()
         date_obj = f"20{date_str[0:2]}-{date_str[2:4]}-{date_str[4:6]}"
         return {'date': date_obj, 'supplier': supplier, 'description': description}
     except Exception as e:
@@ -148,23 +373,102 @@ def dashboard():
     if not session.get('logged_in'): return redirect(url_for('login'))
     
     processed_files_info = []
-    sorted_files = sorted(os.listdir(app.config['PROCESSED_FOLDER']), key=lambda f: os.path.getmtime(os.path.join(app.config['PROCESSED_FOLDER'], f)), reverse=True)
+    q = request.args.get('q', '').strip()
+    where, params = '', ()
+    if q:
+        pattern = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where = "WHERE filename LIKE ? ESCAPE '\\' OR supplier LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\'"
+        params = (pattern, pattern, pattern)
+    total = db_query(f'SELECT COUNT(*) FROM invoices {where}', params)[0][0]
+    total_pages = max(1, -(-total // DASHBOARD_PAGE_SIZE))
+    page = min(max(1, request.args.get('page', 1, type=int)), total_pages)
+    rows = db_query(f'SELECT id, filename, date, supplier, description, has_webp FROM invoices {where} ORDER BY mtime DESC LIMIT ? OFFSET ?',
+                    params + (DASHBOARD_PAGE_SIZE, (page - 1) * DASHBOARD_PAGE_SIZE))
     
-    for filename in sorted_files:
-        parsed_data = parse_filename(filename)
-        base_name = os.path.splitext(filename)[0]
-        details = load_invoice_details(base_name)
-        
+    for row in rows:
         processed_files_info.append({
-            'filename': filename,
-            'preview_image': f"{base_name}.jpg",
-            'date': parsed_data['date'],
-            'supplier': parsed_data['supplier'],
-            'description': parsed_data['description'],
-            'detailed_description': details.get('detailed_description', 'Žádné podrobnosti') if details else 'Žádné podrobnosti'
+            'id': row['id'],
+            'filename': row['filename'],
+            'preview_image': f"{row['id']}.jpg",
+            'preview_webp': f"{row['id']}.webp" if row['has_webp'] else None,
+            'date': row['date'],
+            'supplier': row['supplier'],
+            'description': row['description'],
         })
             
-    return render_template('dashboard.html', files=processed_files_info)
+    return render_template('dashboard.html', files=processed_files_info, page=page, total_pages=total_pages, q=q)
+
+@app.route('/invoice_details/<invoice_id>')
+def invoice_details(invoice_id):
+    if not session.get('logged_in'): return jsonify({'status': 'error', 'message': 'Nepřihlášen'}), 401
+    details = load_invoice_details(invoice_id)
+    if details is None: return jsonify({'status': 'error', 'message': 'Podrobnosti nenalezeny'}), 404
+    return jsonify(details)
+
+async def _extract_with_cache(aclient, semaphore, image_url, image_hash):
+    data = await asyncio.to_thread(get_cached_extraction, image_hash)
+    if data is None:
+        async with semaphore:
+            data, detail = await extract_invoice_data_from_image(aclient, image_url)
+        # Výsledek z "low" může mít odhadnuté datum či ceny, natrvalo se necachuje
+        if data and detail == 'high':
+            try:
+                await asyncio.to_thread(save_cached_extraction, image_hash, data)
+            except OSError as e:
+                print(f"Nepodařilo se uložit výsledek do cache: {e}")
+    return data
+
+async def _process_one(aclient, semaphore, seen_hashes, original_filename, temp_path, file_bytes):
+    try:
+        image_url, image_hash, img = await run_in_raster_pool(get_image_base64, temp_path or file_bytes)
+        if not image_url:
+            return original_filename, "error", f"Nepodařilo se zpracovat soubor na obrázek: {original_filename}"
+
+        # Stejný soubor dvakrát v jedné dávce
+        extraction = seen_hashes.get(image_hash)
+        if extraction is None:
+            extraction = seen_hashes[image_hash] = asyncio.ensure_future(_extract_with_cache(aclient, semaphore, image_url, image_hash))
+        data = await extraction
+        if not data:
+            return original_filename, "error", f"AI nedokázala extrahovat data ze souboru: {original_filename}"
+
+        issue_date = data.get('issue_date', '0000-00-00')
+        supplier = data.get('supplier_name', 'Neznámý dodavatel').strip()
+        description = data.get('description', 'Neznámé zboží').strip()
+
+        _, extension = os.path.splitext(original_filename)
+        final_filename = build_invoice_filename(issue_date, supplier, description, extension)
+
+        invoice_id = uuid.uuid4().hex
+        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{invoice_id}{extension}")
+
+        def persist():
+            has_webp = create_preview(img, f"{invoice_id}.jpg")
+            if temp_path:
+                os.replace(temp_path, processed_path)
+            else:
+                with open(processed_path, 'wb') as f:
+                    f.write(file_bytes)
+            db_write('INSERT INTO invoices(id, filename, date, supplier, description, detailed, mtime, original_ext, has_webp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (invoice_id, final_filename, issue_date, supplier, description, _detailed_text(data), time.time(), extension, has_webp))
+        await asyncio.to_thread(persist)
+
+        return original_filename, "success", f"Faktura '{original_filename}' byla úspěšně zpracována."
+
+    except Exception as e:
+        if "PopplerNotFound" in str(e):
+            return original_filename, "error", f"Chyba při zpracování PDF '{original_filename}'. Nástroj Poppler nebyl nalezen."
+        return original_filename, "error", f"Neznámá chyba při zpracování '{original_filename}'."
+    finally:
+        if temp_path: _silent_unlink(temp_path)
+
+async def _process_batch(jobs):
+    # httpx klient je vázaný na event loop, proto nový pro každou dávku
+    semaphore = asyncio.Semaphore(UPLOAD_MAX_CONCURRENCY)
+    seen_hashes = {}
+    http_client = DefaultAsyncHttpxClient(http2=True, limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT)
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client) as aclient:
+        return await asyncio.gather(*(_process_one(aclient, semaphore, seen_hashes, *job) for job in jobs))
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_page():
@@ -176,95 +480,71 @@ def upload_page():
         flash("Nebyly vybrány žádné soubory.", "warning")
         return redirect(url_for('upload_page'))
 
+    # Na disk jdou jen PDF pro Poppler, obrázky zůstávají v paměti
+    jobs = []
     for file in files:
         original_filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], original_filename)
-        file.save(temp_path)
-
-        try:
-            base64_image = get_image_base64(temp_path)
-            if not base64_image:
-                flash(f"Nepodařilo se zpracovat soubor na obrázek: {original_filename}", "error")
-                if os.path.exists(temp_path): os.remove(temp_path)
-                continue
-
-            data = extract_invoice_data_from_image(base64_image)
-            if not data:
-                flash(f"AI nedokázala extrahovat data ze souboru: {original_filename}", "error")
-                continue
-            
-            date_str = data.get('issue_date', '0000-00-00').replace('-', '')[2:]
-            supplier = data.get('supplier_name', 'Neznámý dodavatel').strip()
-            description = data.get('description', 'Neznámé zboží').strip()
-            
-            _, extension = os.path.splitext(original_filename)
-            
-            # *** PŘESNÝ FORMÁT NÁZVU SOUBORU ***
-            base_new_filename = f"{date_str} ({supplier}), ({description}), E F ZAP"
-            
-            invalid_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in invalid_chars: base_new_filename = base_new_filename.replace(char, '')
-            
-            final_filename = f"{base_new_filename.strip()}{extension}"
-            processed_path = os.path.join(app.config['PROCESSED_FOLDER'], final_filename)
-            
-            base_name_for_db = os.path.splitext(final_filename)[0]
-            preview_filename = f"{base_name_for_db}.jpg"
-            create_preview(temp_path, preview_filename)
-            os.rename(temp_path, processed_path)
-            
-            save_invoice_details(base_name_for_db, data)
-            
-            flash(f"Faktura '{original_filename}' byla úspěšně zpracována.", "success")
+        if original_filename.lower().endswith('.pdf'):
+            fd, temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.pdf')
+            os.close(fd)
+            file.save(temp_path)
+            jobs.append((original_filename, temp_path, None))
+        else:
+            jobs.append((original_filename, None, file.stream.read()))
 
-        except Exception as e:
-            if "PopplerNotFound" in str(e):
-                flash(f"Chyba při zpracování PDF '{original_filename}'. Nástroj Poppler nebyl nalezen.", "error")
-            else:
-                flash(f"Neznámá chyba při zpracování '{original_filename}'.", "error")
-            if os.path.exists(temp_path): os.remove(temp_path)
-            continue
+    for _, status, message in asyncio.run(_process_batch(jobs)):
+        flash(message, status)
 
     return redirect(url_for('dashboard'))
 
-@app.route('/delete_invoice/<filename>', methods=['POST'])
-def delete_invoice(filename):
+@app.route('/download/<invoice_id>')
+def download_invoice(invoice_id):
+    if not session.get('logged_in'): return redirect(url_for('login'))
+    rows = db_query('SELECT filename, original_ext FROM invoices WHERE id = ?', (invoice_id,))
+    if not rows: return "Faktura nenalezena", 404
+    return send_from_directory(app.config['PROCESSED_FOLDER'], f"{invoice_id}{rows[0]['original_ext']}",
+                               as_attachment=True, download_name=rows[0]['filename'])
+
+@app.route('/delete_invoice/<invoice_id>', methods=['POST'])
+def delete_invoice(invoice_id):
     if not session.get('logged_in'): return jsonify({'status': 'error', 'message': 'Nepřihlášen'}), 401
     try:
-        base_name = os.path.splitext(filename)[0]
-        os.remove(os.path.join(app.config['PROCESSED_FOLDER'], filename))
-        os.remove(os.path.join(app.config['PREVIEW_FOLDER'], f"{base_name}.jpg"))
-        os.remove(os.path.join(app.config['DB_FOLDER'], f"{base_name}.json"))
+        rows = db_query('SELECT original_ext FROM invoices WHERE id = ?', (invoice_id,))
+        if not rows: return jsonify({'status': 'error', 'message': 'Faktura nenalezena'}), 404
+        db_write('DELETE FROM invoices WHERE id = ?', (invoice_id,))
+        _silent_unlink(os.path.join(app.config['PROCESSED_FOLDER'], f"{invoice_id}{rows[0]['original_ext']}"))
+        _silent_unlink(os.path.join(app.config['PREVIEW_FOLDER'], f"{invoice_id}.jpg"))
+        _silent_unlink(os.path.join(app.config['PREVIEW_FOLDER'], f"{invoice_id}.webp"))
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/edit_invoice/<filename>', methods=['POST'])
-def edit_invoice_submit(filename):
+@app.route('/edit_invoice/<invoice_id>', methods=['POST'])
+def edit_invoice_submit(invoice_id):
     if not session.get('logged_in'): return jsonify({'status': 'error', 'message': 'Nepřihlášen'}), 401
     
-    data = request.json
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify({'status': 'error', 'message': 'Neplatná data'}), 400
     new_supplier = data.get('supplier')
     new_description = data.get('description')
     new_date = data.get('date') # Očekává RRRR-MM-DD
 
+    if not all(isinstance(value, str) and value.strip() for value in (new_supplier, new_description, new_date)):
+        return jsonify({'status': 'error', 'message': 'Dodavatel, popis i datum musí být vyplněny'}), 400
+    new_supplier, new_description, new_date = new_supplier.strip(), new_description.strip(), new_date.strip()
     try:
-        date_str = new_date.replace('-', '')[2:]
-        base_new_filename = f"{date_str} ({new_supplier}), ({new_description}), E F ZAP"
-        
-        invalid_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-        for char in invalid_chars: base_new_filename = base_new_filename.replace(char, '')
-        
-        _, extension = os.path.splitext(filename)
-        new_filename = f"{base_new_filename.strip()}{extension}"
-        
-        old_base = os.path.splitext(filename)[0]
-        new_base = os.path.splitext(new_filename)[0]
-
-        # Přejmenování všech souvisejících souborů
-        os.rename(os.path.join(app.config['PROCESSED_FOLDER'], filename), os.path.join(app.config['PROCESSED_FOLDER'], new_filename))
-        os.rename(os.path.join(app.config['PREVIEW_FOLDER'], f"{old_base}.jpg"), os.path.join(app.config['PREVIEW_FOLDER'], f"{new_base}.jpg"))
-        os.rename(os.path.join(app.config['DB_FOLDER'], f"{old_base}.json"), os.path.join(app.config['DB_FOLDER'], f"{new_base}.json"))
+        if not _ISO_DATE_RE.match(new_date): raise ValueError(new_date)
+        datetime.strptime(new_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Datum musí být ve formátu RRRR-MM-DD'}), 400
+
+    try:
+        rows = db_query('SELECT original_ext FROM invoices WHERE id = ?', (invoice_id,))
+        if not rows: return jsonify({'status': 'error', 'message': 'Faktura nenalezena'}), 404
+        new_filename = build_invoice_filename(new_date, new_supplier, new_description, rows[0]['original_ext'])
+
+        db_write('UPDATE invoices SET filename = ?, date = ?, supplier = ?, description = ? WHERE id = ?',
+                 (new_filename, new_date, new_supplier, new_description, invoice_id))
 
         return jsonify({'status': 'success', 'new_filename': new_filename})
     except Exception as e:
@@ -274,7 +554,10 @@ def edit_invoice_submit(filename):
 @app.route('/previews/<filename>')
 def get_preview(filename):
     if not session.get('logged_in'): return redirect(url_for('login'))
-    return send_from_directory(app.config['PREVIEW_FOLDER'], filename)
+    # Náhled podle id se nikdy nemění; jen v prohlížeči, ne ve sdílených cache
+    response = send_from_directory(app.config['PREVIEW_FOLDER'], filename, conditional=True)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 
 if __name__ == '__main__':